@@ -1,19 +1,28 @@
 """Production Streamlit dashboard for food spoilage detection"""
 import random
+import time
 from datetime import datetime
 from typing import Dict, Any, List
+import numpy as np
 import pandas as pd
 import altair as alt
+import msgspec
 import streamlit as st
 from streamlit_autorefresh import st_autorefresh
 import structlog
 
 from config import settings
 from models import create_tables
-from services.sensor_service import SensorService
+from services.sensor_service import SensorService, classify_ratios
 from services.alert_service import AlertService
 
 # Configure logging
+_log_encoder = msgspec.json.Encoder(enc_hook=str)
+
+def render_json(_, __, event_dict: Dict[str, Any]) -> str:
+    """Render log events with msgspec's JSON encoder instead of stdlib json"""
+    return _log_encoder.encode(event_dict).decode()
+
 structlog.configure(
     processors=[
         structlog.stdlib.filter_by_level,
@@ -24,7 +33,7 @@ structlog.configure(
         structlog.processors.StackInfoRenderer(),
         structlog.processors.format_exc_info,
         structlog.processors.UnicodeDecoder(),
-        structlog.processors.JSONRenderer()
+        render_json
     ],
     context_class=dict,
     logger_factory=structlog.stdlib.LoggerFactory(),
@@ -34,9 +43,6 @@ structlog.configure(
 
 logger = structlog.get_logger()
 
-# Initialize database
-create_tables()
-
 # Page config
 st.set_page_config(
     page_title="Food Spoilage Monitor",
@@ -45,6 +51,18 @@ st.set_page_config(
     initial_sidebar_state="expanded"
 )
 
+# Initialize database once per process, not on every rerun
+@st.cache_resource
+def init_database():
+    create_tables()
+
+try:
+    init_database()
+except RuntimeError as e:
+    logger.error("Database setup failed", error=str(e))
+    st.error(f"Database setup failed: {e}")
+    st.stop()
+
 # Initialize services
 @st.cache_resource
 def get_services():
@@ -52,11 +70,11 @@ def get_services():
 
 sensor_service, alert_service = get_services()
 
-def get_mock_reading() -> Dict[str, Any]:
+MAX_POLL_INTERVAL = 60
+CHART_MAX_POINTS = 500
+
+def get_mock_reading(mock_ro: float) -> Dict[str, Any]:
     """Generate mock sensor reading for testing"""
-    mock_ro = st.session_state.get("mock_ro", random.uniform(200000, 700000))
-    st.session_state["mock_ro"] = mock_ro
-    
     return {
         "device": "mock_esp32",
         "Ro": round(mock_ro, 2),
@@ -65,19 +83,53 @@ def get_mock_reading() -> Dict[str, Any]:
         "status": "mock"
     }
 
-def process_reading(raw_data: Dict[str, Any], device_id: str) -> Dict[str, Any]:
+def lttb_indices(x: np.ndarray, y: np.ndarray, n_out: int) -> np.ndarray:
+    """Pick n_out points that keep the shape of the series (Largest-Triangle-Three-Buckets)
+    
+    ``x`` must be ascending. The first and last points are always kept.
+    """
+    n = len(x)
+    if n_out >= n or n_out < 3:
+        return np.arange(n)
+    
+    # n_out - 2 buckets between the fixed first and last points
+    edges = np.linspace(1, n - 1, n_out - 1).astype(np.intp)
+    selected = np.empty(n_out, dtype=np.intp)
+    selected[0], selected[-1] = 0, n - 1
+    
+    a = 0
+    for i in range(n_out - 2):
+        start, end = edges[i], edges[i + 1]
+        next_end = edges[i + 2] if i + 2 < len(edges) else n
+        avg_x = x[end:next_end].mean()
+        avg_y = y[end:next_end].mean()
+        
+        # Keep the point forming the largest triangle with the previous pick
+        # and the next bucket's average
+        area = np.abs(
+            (x[a] - avg_x) * (y[start:end] - y[a])
+            - (x[a] - x[start:end]) * (avg_y - y[a])
+        )
+        a = start + int(area.argmax())
+        selected[i + 1] = a
+    
+    return selected
+
+def process_reading(raw_data: Dict[str, Any], device_id: str, alert_phone: str) -> Dict[str, Any]:
     """Process and save sensor reading"""
     try:
         normalized = sensor_service.normalize_reading(raw_data, device_id)
-        reading = sensor_service.save_reading(normalized)
+        sensor_service.save_reading(normalized)
+        # Write through now so the history below includes this reading
+        sensor_service.flush()
         
         # Check for alerts
         ratio = normalized["ratio"]
         if ratio <= settings.RATIO_WARNING:
             alert_type = "spoiled"
-            phone = st.session_state.get("alert_phone")
-            if phone and alert_service.should_send_alert(device_id, alert_type):
-                alert_service.create_alert(device_id, alert_type, ratio, phone)
+            if alert_phone:
+                # create_alert applies the cooldown before calling
+                alert_service.create_alert(device_id, alert_type, ratio, alert_phone)
         elif ratio <= settings.RATIO_FRESH:
             alert_type = "warning"
             alert_service.create_alert(device_id, alert_type, ratio)
@@ -91,6 +143,23 @@ def process_reading(raw_data: Dict[str, Any], device_id: str) -> Dict[str, Any]:
         logger.error("Processing failed", error=str(e))
         raise
 
+@st.cache_data(ttl=MAX_POLL_INTERVAL, max_entries=8, show_spinner=False)
+def read_once(device_id: str, device_url: str, mock_mode: bool, mock_ro: float,
+              alert_phone: str, refresh_tick: int) -> Dict[str, Any]:
+    """Fetch and process one reading per poll interval
+    
+    ``refresh_tick`` is a wall-clock bucket, so every session and page reload
+    within the same interval shares one reading instead of hitting the device
+    and database again. The cache is shared across sessions, so everything
+    session-specific is passed in and becomes part of the cache key.
+    """
+    if mock_mode:
+        raw_data = get_mock_reading(mock_ro)
+    else:
+        raw_data = sensor_service.fetch_device_status(device_url)
+    
+    return process_reading(raw_data, device_id, alert_phone)
+
 # Sidebar configuration
 with st.sidebar:
     st.header("⚙️ Configuration")
@@ -110,7 +179,7 @@ with st.sidebar:
     poll_interval = st.slider(
         "Poll Interval (seconds)",
         min_value=1,
-        max_value=60,
+        max_value=MAX_POLL_INTERVAL,
         value=st.session_state.get("poll_interval", settings.POLL_INTERVAL)
     )
     
@@ -163,7 +232,7 @@ st.title("🥬 Food Spoilage Detection System")
 st.markdown("Real-time monitoring with MQ-135 gas sensor")
 
 # Auto-refresh
-count = st_autorefresh(
+st_autorefresh(
     interval=poll_interval * 1000,
     limit=None,
     key="auto_refresh"
@@ -172,12 +241,13 @@ count = st_autorefresh(
 # Fetch and process data
 error_msg = None
 try:
-    if mock_mode:
-        raw_data = get_mock_reading()
-    else:
-        raw_data = sensor_service.fetch_device_status(device_url)
-    
-    current_reading = process_reading(raw_data, device_id)
+    mock_ro = st.session_state.setdefault("mock_ro", random.uniform(200000, 700000))
+    current_reading = read_once(
+        device_id, device_url, mock_mode,
+        mock_ro if mock_mode else None,
+        alert_phone,
+        int(time.time() // poll_interval)
+    )
     
 except Exception as e:
     error_msg = str(e)
@@ -226,32 +296,46 @@ with col2:
     st.subheader("📈 Historical Data")
     
     # Get historical data
-    history = sensor_service.get_readings_history(device_id, hours=24, limit=500)
+    history = sensor_service.get_readings_history(device_id, hours=24, limit=settings.MAX_HISTORY)
+    df = pd.DataFrame(history, copy=False)
     
-    if history:
-        df = pd.DataFrame(history)
-        df['timestamp'] = pd.to_datetime(df['timestamp'])
+    if not df.empty:
+        # Chart an ascending, downsampled copy so the payload stays bounded
+        chart_df = df.iloc[::-1]
+        keep = lttb_indices(
+            chart_df['timestamp'].astype('int64').to_numpy(dtype=np.float64),
+            chart_df['ratio'].to_numpy(dtype=np.float64),
+            CHART_MAX_POINTS
+        )
+        # Status bucket per charted point (0 spoiled, 1 warning, 2 fresh),
+        # computed here instead of per point in the browser
+        chart_df = chart_df.iloc[keep].assign(
+            bucket=lambda d: classify_ratios(d['ratio'], ratio_warning, ratio_fresh)
+        )
         
         # Create charts
-        base = alt.Chart(df).add_selection(
+        base = alt.Chart(chart_df).add_selection(
             alt.selection_interval(bind='scales')
         )
         
         # Ratio chart with thresholds
-        ratio_chart = base.mark_line(point=True).encode(
+        ratio_line = base.mark_line().encode(
             x=alt.X('timestamp:T', title='Time'),
-            y=alt.Y('ratio:Q', title='Ratio (Rs/Ro)'),
-            color=alt.condition(
-                alt.datum.ratio <= ratio_warning,
-                alt.value('red'),
-                alt.condition(
-                    alt.datum.ratio <= ratio_fresh,
-                    alt.value('orange'),
-                    alt.value('green')
-                )
+            y=alt.Y('ratio:Q', title='Ratio (Rs/Ro)')
+        )
+        
+        ratio_points = alt.Chart(chart_df).mark_point(filled=True).encode(
+            x='timestamp:T',
+            y='ratio:Q',
+            color=alt.Color(
+                'bucket:N',
+                scale=alt.Scale(domain=[0, 1, 2], range=['red', 'orange', 'green']),
+                legend=None
             ),
             tooltip=['timestamp:T', 'ratio:Q', 'rs:Q', 'ro:Q']
-        ).properties(height=200)
+        )
+        
+        ratio_chart = (ratio_line + ratio_points).properties(height=200)
         
         # Add threshold lines
         warning_line = alt.Chart(pd.DataFrame({'y': [ratio_warning]})).mark_rule(
@@ -279,7 +363,7 @@ with col2:
         
         # Recent readings table
         st.subheader("Recent Readings")
-        display_df = df[['timestamp', 'ratio', 'rs', 'ro', 'vout', 'is_alert']].head(10)
+        display_df = df[['timestamp', 'ratio', 'rs', 'ro', 'vout', 'is_alert']].iloc[:10].copy()
         display_df['timestamp'] = display_df['timestamp'].dt.strftime('%H:%M:%S')
         st.dataframe(display_df, use_container_width=True)
         
@@ -301,6 +385,7 @@ col1, col2, col3 = st.columns(3)
 
 with col1:
     if st.button("🔄 Fetch Now"):
+        read_once.clear()
         st.rerun()
 
 with col2:
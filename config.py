@@ -1,7 +1,8 @@
 """Production configuration management"""
 import os
 from typing import Optional
-from pydantic import BaseSettings, validator
+from pydantic import field_validator
+from pydantic_settings import BaseSettings, SettingsConfigDict
 
 class Settings(BaseSettings):
     # Database
@@ -14,6 +15,11 @@ class Settings(BaseSettings):
     MAX_HISTORY: int = 2000
     REQUEST_TIMEOUT: float = 3.0
     
+    # Storage
+    WRITE_BATCH_SIZE: int = 200
+    WRITE_BATCH_MAX_AGE: float = 1.0
+    WRITE_BUFFER_MAX_ROWS: int = 10000  # oldest readings are dropped beyond this
+    
     # Thresholds
     RATIO_FRESH: float = 0.8
     RATIO_WARNING: float = 0.5
@@ -27,15 +33,18 @@ class Settings(BaseSettings):
     # Monitoring
     PROMETHEUS_PORT: int = 8000
     LOG_LEVEL: str = "INFO"
+    LOG_SAMPLE_RATE: float = 0.1  # share of routine "Reading saved" events logged
     
     # Security
     SECRET_KEY: str = "your-secret-key-change-in-production"
+    # Turns off Streamlit's CORS and XSRF checks; only behind a trusted network
+    STREAMLIT_TRUSTED_NETWORK: bool = False
     
-    class Config:
-        env_file = ".env"
-        case_sensitive = True
+    # Frozen: the module-level instance is a read-only, hashable singleton
+    model_config = SettingsConfigDict(env_file=".env", case_sensitive=True, frozen=True)
 
-    @validator('TWILIO_ACCOUNT_SID')
+    @field_validator('TWILIO_ACCOUNT_SID')
+    @classmethod
     def validate_twilio_sid(cls, v):
         if v and not v.startswith('AC'):
             raise ValueError('Invalid Twilio Account SID')
@@ -1,26 +1,67 @@
 """Data models and database schema"""
-from datetime import datetime
-from typing import Optional
-from sqlalchemy import Column, Integer, Float, String, DateTime, Boolean, create_engine
+from contextlib import contextmanager
+from datetime import date, datetime, timedelta
+from typing import Iterator, List, Optional
+from sqlalchemy import Column, Integer, Float, String, DateTime, Boolean, Index, cast, create_engine, text
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import sessionmaker
-from pydantic import BaseModel
+from sqlalchemy.ext.hybrid import hybrid_property
+from sqlalchemy.orm import Session, sessionmaker
+from pydantic import AliasChoices, BaseModel, Field
 from config import settings
 
 Base = declarative_base()
 
+# Ratio and Vout are stored as fixed-point integers in 1/10000 units
+FIXED_POINT_SCALE = 10000.0
+# Largest values the integer columns can hold, for clamping before storage
+FIXED_POINT_MAX = (2**31 - 1) / FIXED_POINT_SCALE
+OHMS_MAX = 2**31 - 1  # ro/rs are whole ohms; MQ-135 values are ~1e5-1e6
+
+def to_fixed_point(value: float) -> int:
+    return round(value * FIXED_POINT_SCALE)
+
 class SensorReading(Base):
     __tablename__ = "sensor_readings"
     
-    id = Column(Integer, primary_key=True, index=True)
-    timestamp = Column(DateTime, default=datetime.utcnow, index=True)
-    device_id = Column(String, index=True)
-    ro = Column(Float)
-    rs = Column(Float)
-    ratio = Column(Float, index=True)
-    vout = Column(Float)
+    # Partitioned tables need the partition key in the primary key
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    timestamp = Column(DateTime, primary_key=True, default=datetime.utcnow)
+    device_id = Column(String)
+    ro = Column(Integer)  # ohms
+    rs = Column(Integer)  # ohms
+    ratio = Column(Integer, index=True)  # fixed point, see ratio_f
+    vout = Column(Integer)  # fixed point, see vout_f
     status = Column(String)
     is_alert = Column(Boolean, default=False, index=True)
+    
+    @hybrid_property
+    def ratio_f(self) -> float:
+        return self.ratio / FIXED_POINT_SCALE
+    
+    @ratio_f.expression
+    def ratio_f(cls):
+        return cast(cls.ratio, Float) / FIXED_POINT_SCALE
+    
+    @hybrid_property
+    def vout_f(self) -> float:
+        return self.vout / FIXED_POINT_SCALE
+    
+    @vout_f.expression
+    def vout_f(cls):
+        return cast(cls.vout, Float) / FIXED_POINT_SCALE
+    
+    __table_args__ = (
+        # Serves "latest N readings for a device" as an index-only scan;
+        # also covers lookups by device_id alone
+        Index(
+            "ix_readings_device_time",
+            device_id,
+            timestamp.desc(),
+            postgresql_include=["ro", "rs", "ratio", "vout", "status", "is_alert"]
+        ),
+        # One child table per day, see create_reading_partitions()
+        {"postgresql_partition_by": "RANGE (timestamp)"},
+    )
 
 class Device(Base):
     __tablename__ = "devices"
@@ -60,8 +101,9 @@ class SensorReadingResponse(BaseModel):
     device_id: str
     ro: float
     rs: float
-    ratio: float
-    vout: float
+    # Read the decoded floats, not the stored fixed-point integers
+    ratio: float = Field(validation_alias=AliasChoices("ratio_f", "ratio"))
+    vout: float = Field(validation_alias=AliasChoices("vout_f", "vout"))
     status: str
     is_alert: bool
     
@@ -69,11 +111,89 @@ class SensorReadingResponse(BaseModel):
         from_attributes = True
 
 # Database setup
-engine = create_engine(settings.DATABASE_URL)
-SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+engine = create_engine(
+    settings.DATABASE_URL,
+    pool_size=10,
+    max_overflow=20,
+    pool_pre_ping=True,
+    pool_recycle=3600
+)
+# Objects stay usable after their unit of work has committed and closed
+SessionLocal = sessionmaker(autocommit=False, autoflush=False, expire_on_commit=False, bind=engine)
+
+@contextmanager
+def unit_of_work() -> Iterator[Session]:
+    """Pooled session for one unit of work: commit on success, rollback on error"""
+    session = SessionLocal()
+    try:
+        yield session
+        session.commit()
+    except Exception:
+        session.rollback()
+        raise
+    finally:
+        session.close()
 
 def create_tables():
     Base.metadata.create_all(bind=engine)
+    
+    with unit_of_work() as session:
+        # create_all leaves a pre-partitioning sensor_readings table in place,
+        # and it cannot take partitions
+        relkind = session.execute(
+            text("SELECT relkind FROM pg_class WHERE oid = to_regclass(:name)"),
+            {"name": SensorReading.__tablename__},
+        ).scalar()
+        if relkind != "p":
+            raise RuntimeError(
+                f"{SensorReading.__tablename__} is not partitioned; migrate it "
+                "as described in README 'Upgrading an Existing Database'"
+            )
+        create_reading_partitions(session)
+
+def reading_partition_name(day: date) -> str:
+    return f"{SensorReading.__tablename__}_{day:%Y%m%d}"
+
+def create_reading_partitions(session: Session, days_ahead: int = 2) -> List[str]:
+    """Create the daily sensor_readings partitions from today to days_ahead"""
+    today = datetime.utcnow().date()
+    created = []
+    
+    for offset in range(days_ahead + 1):
+        day = today + timedelta(days=offset)
+        name = reading_partition_name(day)
+        session.execute(text(
+            f"CREATE TABLE IF NOT EXISTS {name} "
+            f"PARTITION OF {SensorReading.__tablename__} "
+            f"FOR VALUES FROM ('{day.isoformat()}') TO ('{(day + timedelta(days=1)).isoformat()}')"
+        ))
+        created.append(name)
+    
+    return created
+
+def drop_reading_partitions(session: Session, before: datetime) -> List[str]:
+    """Drop the daily partitions that only hold readings older than ``before``"""
+    partitions = session.execute(text(
+        "SELECT child.relname FROM pg_inherits "
+        "JOIN pg_class parent ON pg_inherits.inhparent = parent.oid "
+        "JOIN pg_class child ON pg_inherits.inhrelid = child.oid "
+        "WHERE parent.relname = :parent"
+    ), {"parent": SensorReading.__tablename__}).scalars().all()
+    
+    prefix = f"{SensorReading.__tablename__}_"
+    dropped = []
+    
+    for name in partitions:
+        try:
+            day = datetime.strptime(name[len(prefix):], "%Y%m%d")
+        except ValueError:
+            continue  # not one of ours
+        
+        if day + timedelta(days=1) <= before:
+            session.execute(text(f"DROP TABLE {name}"))
+            dropped.append(name)
+    
+    return dropped
 
 def get_db():
     db = SessionLocal()
@@ -46,12 +46,25 @@ def main():
     print("📊 Dashboard will be available at: http://localhost:8501")
     print("🔄 Press Ctrl+C to stop")
     
+    # Skip the usage-stats round-trip
+    os.environ["STREAMLIT_BROWSER_GATHER_USAGE_STATS"] = "false"
+    
+    from config import settings
+    
+    command = [
+        sys.executable, "-m", "streamlit", "run", "app.py",
+        "--server.port=8501",
+        "--server.address=0.0.0.0",
+        "--server.enableWebsocketCompression=true",
+        "--server.maxUploadSize=5",
+        # Cancel an in-progress rerun as soon as a newer event arrives
+        "--runner.fastReruns=true"
+    ]
+    if settings.STREAMLIT_TRUSTED_NETWORK:
+        command += ["--server.enableCORS=false", "--server.enableXsrfProtection=false"]
+    
     try:
-        subprocess.run([
-            sys.executable, "-m", "streamlit", "run", "app.py",
-            "--server.port=8501",
-            "--server.address=0.0.0.0"
-        ])
+        subprocess.run(command)
     except KeyboardInterrupt:
         print("\n👋 Shutting down...")
 
@@ -1,17 +1,32 @@
 """Alert and notification service"""
 import urllib.parse
-from datetime import datetime, timedelta
-from typing import Optional
+from datetime import datetime
+from typing import List, Optional, Tuple
+import redis
 import structlog
 from twilio.rest import Client
-from models import Alert, SessionLocal
+from models import Alert, unit_of_work
 from config import settings
 
 logger = structlog.get_logger()
 
+ALERT_TYPES = ("spoiled", "warning")
+
+# Webhook URL for the standard spoilage call with the fixed text already
+# percent-encoded; only the device id and ratio are filled in per call
+_WEBHOOK_TEMPLATE = (
+    settings.WEBHOOK_URL.replace("{", "{{").replace("}", "}}")
+    + "?context="
+    + urllib.parse.quote("Food spoilage alert for device ")
+    + "{device_id}"
+    + urllib.parse.quote(". Current ratio is ")
+    + "{ratio:.3f}"
+    + urllib.parse.quote(".")
+)
+
 class AlertService:
     def __init__(self):
-        self.session = SessionLocal()
+        self.redis_client = redis.from_url(settings.REDIS_URL)
         self.twilio_client = None
         if settings.TWILIO_ACCOUNT_SID and settings.TWILIO_AUTH_TOKEN:
             self.twilio_client = Client(
@@ -20,30 +35,37 @@ class AlertService:
             )
     
     def should_send_alert(self, device_id: str, alert_type: str) -> bool:
-        """Check if alert should be sent (avoid spam)"""
-        cooldown_minutes = 30 if alert_type == "spoiled" else 60
-        since = datetime.utcnow() - timedelta(minutes=cooldown_minutes)
-        
-        recent_alert = self.session.query(Alert)\
-            .filter(
-                Alert.device_id == device_id,
-                Alert.alert_type == alert_type,
-                Alert.timestamp >= since,
-                Alert.is_resolved == False
-            )\
-            .first()
+        """Check if alert should be sent (avoid spam)
         
-        return recent_alert is None
+        Claims the cooldown slot atomically, so a True result also starts
+        the cooldown for the next caller.
+        """
+        cooldown_minutes = 30 if alert_type == "spoiled" else 60
+        return bool(self.redis_client.set(
+            self._cooldown_key(device_id, alert_type),
+            "1",
+            nx=True,
+            ex=cooldown_minutes * 60
+        ))
+    
+    def _cooldown_key(self, device_id: str, alert_type: str) -> str:
+        return f"alert_cd:{device_id}:{alert_type}"
     
-    def send_voice_alert(self, phone_number: str, context: str, device_id: str, ratio: float) -> Optional[str]:
-        """Send voice call alert via Twilio"""
+    def send_voice_alert(self, phone_number: str, context: Optional[str], device_id: str,
+                         ratio: float) -> Optional[str]:
+        """Send voice call alert via Twilio, with the standard spoilage message when context is None"""
         if not self.twilio_client:
             logger.warning("Twilio not configured")
             return None
         
         try:
-            encoded_context = urllib.parse.quote(context)
-            webhook_url = f"{settings.WEBHOOK_URL}?context={encoded_context}"
+            if context is None:
+                webhook_url = _WEBHOOK_TEMPLATE.format(
+                    device_id=urllib.parse.quote(device_id),
+                    ratio=ratio
+                )
+            else:
+                webhook_url = f"{settings.WEBHOOK_URL}?context={urllib.parse.quote(context)}"
             
             call = self.twilio_client.calls.create(
                 to=phone_number,
@@ -76,34 +98,49 @@ class AlertService:
         
         # Send voice alert if phone number provided
         if phone_number and self.should_send_alert(device_id, alert_type):
-            context = f"Food spoilage alert for device {device_id}. Current ratio is {ratio:.3f}."
-            call_sid = self.send_voice_alert(phone_number, context, device_id, ratio)
+            call_sid = self.send_voice_alert(phone_number, None, device_id, ratio)
             alert.call_sid = call_sid
         
-        self.session.add(alert)
-        self.session.commit()
-        self.session.refresh(alert)
+        # The INSERT's RETURNING fills in alert.id; no reload needed
+        with unit_of_work() as session:
+            session.add(alert)
         
         return alert
     
-    def resolve_alerts(self, device_id: str, alert_type: str = None):
-        """Mark alerts as resolved"""
-        query = self.session.query(Alert)\
-            .filter(Alert.device_id == device_id, Alert.is_resolved == False)
+    def create_alerts(self, alerts: List[Tuple[str, str, float]]) -> int:
+        """Record (device_id, alert_type, ratio) alerts in one INSERT, without calls"""
+        timestamp = datetime.utcnow()
         
-        if alert_type:
-            query = query.filter(Alert.alert_type == alert_type)
+        with unit_of_work() as session:
+            session.bulk_insert_mappings(Alert, [
+                {
+                    "device_id": device_id,
+                    "alert_type": alert_type,
+                    "ratio_value": ratio,
+                    "timestamp": timestamp
+                }
+                for device_id, alert_type, ratio in alerts
+            ])
         
-        alerts = query.all()
-        for alert in alerts:
-            alert.is_resolved = True
+        return len(alerts)
+    
+    def resolve_alerts(self, device_id: str, alert_type: str = None):
+        """Mark alerts as resolved"""
+        with unit_of_work() as session:
+            query = session.query(Alert)\
+                .filter(Alert.device_id == device_id, Alert.is_resolved == False)
+            
+            if alert_type:
+                query = query.filter(Alert.alert_type == alert_type)
+            
+            alerts = query.all()
+            for alert in alerts:
+                alert.is_resolved = True
         
-        self.session.commit()
+        # Resolved alerts no longer suppress new ones
+        alert_types = [alert_type] if alert_type else ALERT_TYPES
+        self.redis_client.delete(*(self._cooldown_key(device_id, t) for t in alert_types))
         
         logger.info("Alerts resolved", 
                    device_id=device_id,
-                   count=len(alerts))
-    
-    def __del__(self):
-        if hasattr(self, 'session'):
-            self.session.close()
\ No newline at end of file
+                   count=len(alerts))
\ No newline at end of file
@@ -1,20 +1,223 @@
 """Sensor data collection and processing service"""
-import json
-from datetime import datetime, timedelta
+import asyncio
+import atexit
+import math
+import random
+import threading
+import time
+from collections import deque
+from datetime import date, datetime, timedelta
 from typing import Dict, Any, Optional, List
+import aiohttp
+import numpy as np
+import orjson
 import requests
 import redis
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import structlog
-from sqlalchemy.orm import Session
-from models import SensorReading, Device, get_db, SessionLocal
+from sqlalchemy import func, select
+from sqlalchemy.exc import OperationalError
+from models import (
+    FIXED_POINT_MAX, OHMS_MAX, SensorReading, create_reading_partitions, to_fixed_point, unit_of_work
+)
 from config import settings
 
 logger = structlog.get_logger()
 
+# Status buckets returned by classify_ratios()
+STATUS_SPOILED, STATUS_WARNING, STATUS_FRESH = 0, 1, 2
+
+HISTORY_COLUMNS = ("timestamp", "device_id", "ro", "rs", "ratio", "vout", "status", "is_alert")
+# Column dtypes for history arrays; anything not listed stays an object array.
+# Floats stay float64 so the chart JSON gets the short repr of each value.
+HISTORY_DTYPES = {
+    "timestamp": "datetime64[us]",
+    "ro": np.float64,
+    "rs": np.float64,
+    "ratio": np.float64,
+    "vout": np.float64,
+    "is_alert": np.bool_,
+}
+HISTORY_CACHE_TTL = min(settings.POLL_INTERVAL, 10)
+
+# Redis clients are thread-safe and connect lazily, so one per process is shared
+# by every SensorService and the background flusher.
+_redis_client = redis.from_url(settings.REDIS_URL)
+
+def classify_ratios(ratios, ratio_warning: float = None, ratio_fresh: float = None) -> np.ndarray:
+    """Bucket ratios into STATUS_SPOILED/WARNING/FRESH in one branchless pass
+    
+    Thresholds are inclusive upper bounds, as in ``ratio <= RATIO_WARNING``.
+    """
+    ratios = np.asarray(ratios)
+    if ratios.dtype.kind != "f":
+        ratios = ratios.astype(np.float64)
+    
+    warning = settings.RATIO_WARNING if ratio_warning is None else ratio_warning
+    fresh = settings.RATIO_FRESH if ratio_fresh is None else ratio_fresh
+    # searchsorted needs sorted bounds; with inverted thresholds nothing is a
+    # warning, matching ``if ratio <= warning: ... elif ratio <= fresh: ...``
+    fresh = max(fresh, warning)
+
+    # Compare at the data's precision so a float32 0.8 still counts as <= 0.8
+    thresholds = np.asarray([warning, fresh], dtype=ratios.dtype)
+    return np.searchsorted(thresholds, ratios).astype(np.int8)
+
+def _history_arrays(columns: Dict[str, List[Any]]) -> Dict[str, np.ndarray]:
+    """Turn history column lists into one contiguous array per column"""
+    return {
+        name: np.asarray(values, dtype=HISTORY_DTYPES.get(name, object))
+        for name, values in columns.items()
+    }
+
+def _history_index_key(device_id: str) -> str:
+    """Redis set tracking every cached history key for a device"""
+    return f"hist_keys:{device_id}"
+
+def invalidate_history_cache(device_ids) -> None:
+    """Drop cached history windows for the given devices"""
+    index_keys = [_history_index_key(d) for d in set(device_ids)]
+    if not index_keys:
+        return
+    
+    pipe = _redis_client.pipeline()
+    for index_key in index_keys:
+        pipe.smembers(index_key)
+    cached_keys = [key for members in pipe.execute() for key in members]
+    
+    _redis_client.delete(*cached_keys, *index_keys)
+
+# Pending readings shared by every SensorService in the process, drained in
+# batches so N readings cost one INSERT + COMMIT instead of N. Bounded so a
+# database outage can't grow it without limit; the oldest rows go first.
+_write_buffer: deque = deque(maxlen=settings.WRITE_BUFFER_MAX_ROWS)
+_buffer_lock = threading.Lock()
+_flusher: Optional[threading.Thread] = None
+# UTC day the upcoming partitions were last ensured for by this process
+_partitions_day: Optional[date] = None
+
+def _ensure_partitions() -> None:
+    """Create the upcoming daily partitions once per UTC day
+    
+    Done by the writer itself so readings keep landing in a partition
+    even when no Celery beat is running.
+    """
+    global _partitions_day
+    today = datetime.utcnow().date()
+    if _partitions_day == today:
+        return
+    
+    with unit_of_work() as session:
+        create_reading_partitions(session)
+    _partitions_day = today
+
+def _requeue(rows: List[Dict[str, Any]]) -> None:
+    """Put unwritten rows back ahead of newer ones, dropping the oldest on overflow"""
+    with _buffer_lock:
+        pending = rows + list(_write_buffer)
+        _write_buffer.clear()
+        _write_buffer.extend(pending)
+    
+    dropped = len(pending) - len(_write_buffer)
+    if dropped:
+        logger.warning("Write buffer full, oldest readings dropped", count=dropped)
+
+def _insert_rows_individually(rows: List[Dict[str, Any]]) -> int:
+    """Insert rows one by one, dropping those the database rejects"""
+    inserted = 0
+    for i, row in enumerate(rows):
+        try:
+            with unit_of_work() as session:
+                session.bulk_insert_mappings(SensorReading, [row])
+        except OperationalError:
+            # Database went away mid-way; keep the rest for the next flush
+            _requeue(rows[i:])
+            raise
+        except Exception as e:
+            logger.error("Reading rejected, dropped",
+                        device_id=row["device_id"],
+                        timestamp=str(row["timestamp"]),
+                        error=str(e))
+        else:
+            inserted += 1
+    return inserted
+
+def flush_readings() -> int:
+    """Write all buffered readings with a single multi-row INSERT
+    
+    Connection-level failures put the batch back for the next flush. Any
+    other database error falls back to row-by-row inserts so a single bad
+    row is dropped instead of blocking every later flush.
+    """
+    with _buffer_lock:
+        if not _write_buffer:
+            return 0
+        batch = list(_write_buffer)
+        _write_buffer.clear()
+    
+    try:
+        _ensure_partitions()
+    except Exception as e:
+        # Retried on the next flush; today's partition usually exists already
+        logger.error("Partition creation failed", error=str(e))
+    
+    try:
+        with unit_of_work() as session:
+            session.bulk_insert_mappings(SensorReading, batch)
+        inserted = len(batch)
+    except OperationalError as e:
+        _requeue(batch)
+        logger.error("Reading flush failed", count=len(batch), error=str(e))
+        raise
+    except Exception as e:
+        logger.warning("Batch insert rejected, retrying row by row", count=len(batch), error=str(e))
+        inserted = _insert_rows_individually(batch)
+    
+    try:
+        invalidate_history_cache(row["device_id"] for row in batch)
+    except redis.RedisError as e:
+        # Rows are committed; stale windows expire after HISTORY_CACHE_TTL anyway
+        logger.warning("History cache invalidation failed", error=str(e))
+    
+    logger.debug("Readings flushed", count=inserted)
+    return inserted
+
+def _flush_loop():
+    while True:
+        time.sleep(settings.WRITE_BATCH_MAX_AGE)
+        try:
+            flush_readings()
+        except Exception:
+            pass  # already logged, batch is retried on the next tick
+
+def _ensure_flusher():
+    """Start the background flusher (again after a fork, threads don't survive it)"""
+    global _flusher
+    with _buffer_lock:
+        if _flusher is None or not _flusher.is_alive():
+            _flusher = threading.Thread(target=_flush_loop, name="reading-flusher", daemon=True)
+            _flusher.start()
+
+atexit.register(flush_readings)
+
 class SensorService:
     def __init__(self):
-        self.redis_client = redis.from_url(settings.REDIS_URL)
-        self.session = SessionLocal()
+        # Shared across Streamlit sessions, so no database session is held
+        # here; each method takes its own from the pool via unit_of_work()
+        self.redis_client = _redis_client
+        
+        # Keep-alive connections to the devices instead of a new TCP connect per poll
+        self._http = requests.Session()
+        adapter = HTTPAdapter(
+            pool_connections=64,
+            pool_maxsize=64,
+            # Retry gateway errors only; a timed-out device would double the wait
+            max_retries=Retry(total=1, connect=0, read=0, backoff_factor=0.1,
+                              status_forcelist=(502, 503, 504))
+        )
+        self._http.mount("http://", adapter)
+        self._http.mount("https://", adapter)
     
     def fetch_device_status(self, device_url: str, timeout: float = None) -> Dict[str, Any]:
         """Fetch status from ESP32 device with error handling"""
@@ -22,9 +225,9 @@ class SensorService:
         url = device_url.rstrip("/") + "/status"
         
         try:
-            response = requests.get(url, timeout=timeout)
+            response = self._http.get(url, timeout=timeout)
             response.raise_for_status()
-            return response.json()
+            return orjson.loads(response.content)
         except requests.exceptions.Timeout:
             logger.error("Device timeout", device_url=device_url)
             raise
@@ -35,16 +238,42 @@ class SensorService:
             logger.error("Device fetch failed", device_url=device_url, error=str(e))
             raise
     
+    async def fetch_device_status_async(self, http: aiohttp.ClientSession, device_url: str,
+                                        timeout: float = None) -> Dict[str, Any]:
+        """Fetch status from ESP32 device without blocking, for concurrent polling"""
+        timeout = timeout or settings.REQUEST_TIMEOUT
+        url = device_url.rstrip("/") + "/status"
+        
+        try:
+            async with http.get(url, timeout=aiohttp.ClientTimeout(total=timeout)) as response:
+                response.raise_for_status()
+                # Devices don't always send a JSON content type
+                return await response.json(content_type=None, loads=orjson.loads)
+        except asyncio.TimeoutError:
+            logger.error("Device timeout", device_url=device_url)
+            raise
+        except aiohttp.ClientConnectionError:
+            logger.error("Device connection failed", device_url=device_url)
+            raise
+        except Exception as e:
+            logger.error("Device fetch failed", device_url=device_url, error=str(e))
+            raise
+    
     def normalize_reading(self, raw_data: Dict[str, Any], device_id: str) -> Dict[str, Any]:
         """Normalize and validate sensor reading"""
         def safe_float(value, default=0.0):
             try:
-                return float(value) if value is not None else default
+                result = float(value) if value is not None else default
             except (ValueError, TypeError):
                 return default
+            return result if math.isfinite(result) else default
         
-        ro = safe_float(raw_data.get("Ro", 0.0))
-        rs = safe_float(raw_data.get("Rs", 0.0))
+        def clamp(value, limit):
+            # Keep values storable; an uncalibrated Ro near 0 gives huge ratios
+            return min(max(value, -limit), limit)
+        
+        ro = clamp(safe_float(raw_data.get("Ro", 0.0)), OHMS_MAX)
+        rs = clamp(safe_float(raw_data.get("Rs", 0.0)), OHMS_MAX)
         ratio = safe_float(raw_data.get("ratio"))
         
         if ratio == 0.0 and ro > 0:
@@ -54,44 +283,65 @@ class SensorService:
             "device_id": device_id,
             "ro": ro,
             "rs": rs,
-            "ratio": ratio,
-            "vout": safe_float(raw_data.get("Vout", 0.0)),
+            "ratio": clamp(ratio, FIXED_POINT_MAX),
+            "vout": clamp(safe_float(raw_data.get("Vout", 0.0)), FIXED_POINT_MAX),
             "status": raw_data.get("status", ""),
             "timestamp": datetime.utcnow()
         }
     
-    def save_reading(self, reading_data: Dict[str, Any]) -> SensorReading:
-        """Save sensor reading to database"""
+    def save_reading(self, reading_data: Dict[str, Any]) -> Dict[str, Any]:
+        """Queue sensor reading for the next batched database write
+        
+        Returns the row in its stored form: whole ohms and fixed-point
+        ratio/vout.
+        """
         is_alert = reading_data["ratio"] <= settings.RATIO_WARNING
         
-        reading = SensorReading(
-            device_id=reading_data["device_id"],
-            ro=reading_data["ro"],
-            rs=reading_data["rs"],
-            ratio=reading_data["ratio"],
-            vout=reading_data["vout"],
-            status=reading_data["status"],
-            is_alert=is_alert,
-            timestamp=reading_data["timestamp"]
-        )
+        row = {
+            "device_id": reading_data["device_id"],
+            "ro": round(reading_data["ro"]),
+            "rs": round(reading_data["rs"]),
+            "ratio": to_fixed_point(reading_data["ratio"]),
+            "vout": to_fixed_point(reading_data["vout"]),
+            "status": reading_data["status"],
+            "is_alert": is_alert,
+            "timestamp": reading_data["timestamp"]
+        }
+        
+        _ensure_flusher()
+        with _buffer_lock:
+            full = len(_write_buffer) == _write_buffer.maxlen
+            _write_buffer.append(row)
+            buffered = len(_write_buffer)
         
-        self.session.add(reading)
-        self.session.commit()
-        self.session.refresh(reading)
+        if full:
+            logger.warning("Write buffer full, oldest reading dropped")
         
         cache_key = f"latest_reading:{reading_data['device_id']}"
         self.redis_client.setex(
             cache_key, 
             300,
-            json.dumps(reading_data, default=str)
+            orjson.dumps(reading_data)
         )
         
-        logger.info("Reading saved", 
-                   device_id=reading_data["device_id"],
-                   ratio=reading_data["ratio"],
-                   is_alert=is_alert)
+        # Alerting readings are always logged, routine ones are sampled
+        if is_alert or random.random() < settings.LOG_SAMPLE_RATE:
+            logger.info("Reading saved", 
+                       device_id=reading_data["device_id"],
+                       ratio=reading_data["ratio"],
+                       is_alert=is_alert)
         
-        return reading
+        if buffered >= settings.WRITE_BATCH_SIZE:
+            try:
+                self.flush()
+            except Exception:
+                pass  # already logged, the row stays buffered for the next flush
+        
+        return row
+    
+    def flush(self) -> int:
+        """Write buffered readings now, e.g. at the end of a dashboard run"""
+        return flush_readings()
     
     def get_latest_reading(self, device_id: str) -> Optional[Dict[str, Any]]:
         """Get latest reading from cache or database"""
@@ -99,20 +349,21 @@ class SensorService:
         cached = self.redis_client.get(cache_key)
         
         if cached:
-            return json.loads(cached)
+            return orjson.loads(cached)
         
-        reading = self.session.query(SensorReading)\
-            .filter(SensorReading.device_id == device_id)\
-            .order_by(SensorReading.timestamp.desc())\
-            .first()
+        with unit_of_work() as session:
+            reading = session.query(SensorReading)\
+                .filter(SensorReading.device_id == device_id)\
+                .order_by(SensorReading.timestamp.desc())\
+                .first()
         
         if reading:
             return {
                 "device_id": reading.device_id,
                 "ro": reading.ro,
                 "rs": reading.rs,
-                "ratio": reading.ratio,
-                "vout": reading.vout,
+                "ratio": reading.ratio_f,
+                "vout": reading.vout_f,
                 "status": reading.status,
                 "timestamp": reading.timestamp,
                 "is_alert": reading.is_alert
@@ -120,30 +371,73 @@ class SensorService:
         
         return None
     
-    def get_readings_history(self, device_id: str, hours: int = 24, limit: int = 1000) -> List[Dict[str, Any]]:
-        """Get historical readings for a device"""
+    def get_readings_history(self, device_id: str, hours: int = 24, limit: int = 1000) -> Dict[str, np.ndarray]:
+        """Get historical readings for a device, newest first, as one array per column
+        
+        The arrays back a ``pd.DataFrame`` without copying, and the raw
+        columns are cached briefly in Redis.
+        """
+        cache_key = f"hist:{device_id}:{hours}:{limit}"
+        cached = self.redis_client.get(cache_key)
+        
+        if cached:
+            return _history_arrays(orjson.loads(cached))
+        
         since = datetime.utcnow() - timedelta(hours=hours)
         
-        readings = self.session.query(SensorReading)\
-            .filter(
+        # Same order as HISTORY_COLUMNS; fixed-point columns come back as floats
+        query = select(
+                SensorReading.timestamp,
+                SensorReading.device_id,
+                SensorReading.ro,
+                SensorReading.rs,
+                SensorReading.ratio_f.label("ratio"),
+                SensorReading.vout_f.label("vout"),
+                SensorReading.status,
+                SensorReading.is_alert
+            )\
+            .where(
                 SensorReading.device_id == device_id,
                 SensorReading.timestamp >= since
             )\
             .order_by(SensorReading.timestamp.desc())\
-            .limit(limit)\
-            .all()
-        
-        return [{
-            "timestamp": r.timestamp,
-            "device_id": r.device_id,
-            "ro": r.ro,
-            "rs": r.rs,
-            "ratio": r.ratio,
-            "vout": r.vout,
-            "status": r.status,
-            "is_alert": r.is_alert
-        } for r in readings]
-    
-    def __del__(self):
-        if hasattr(self, 'session'):
-            self.session.close()
\ No newline at end of file
+            .limit(limit)
+        
+        with unit_of_work() as session:
+            rows = session.execute(query).all()
+        columns = zip(*rows) if rows else ([] for _ in HISTORY_COLUMNS)
+        history = {name: list(values) for name, values in zip(HISTORY_COLUMNS, columns)}
+        
+        pipe = self.redis_client.pipeline()
+        pipe.setex(cache_key, HISTORY_CACHE_TTL, orjson.dumps(history))
+        pipe.sadd(_history_index_key(device_id), cache_key)
+        pipe.execute()
+        
+        return _history_arrays(history)
+    
+    def get_readings_stats(self, device_id: str, hours: int = 24) -> Dict[str, Any]:
+        """Aggregate a device's readings in the database, without transferring rows"""
+        since = datetime.utcnow() - timedelta(hours=hours)
+        
+        query = select(
+                func.count(),
+                func.avg(SensorReading.ratio_f),
+                func.min(SensorReading.ratio_f),
+                func.max(SensorReading.ratio_f),
+                func.count().filter(SensorReading.is_alert)
+            )\
+            .where(
+                SensorReading.device_id == device_id,
+                SensorReading.timestamp >= since
+            )
+        
+        with unit_of_work() as session:
+            count, avg_ratio, min_ratio, max_ratio, alert_count = session.execute(query).one()
+        
+        return {
+            "readings_count": count,
+            "avg_ratio": avg_ratio,
+            "min_ratio": min_ratio,
+            "max_ratio": max_ratio,
+            "alert_count": alert_count
+        }
\ No newline at end of file
@@ -1,12 +1,30 @@
 """Background tasks for data collection and processing"""
+import asyncio
 from celery import Celery
+from celery.signals import worker_process_init
 from datetime import datetime, timedelta
+from typing import Any, Dict, List, Optional, Tuple
+import aiohttp
+import numpy as np
+import orjson
 import structlog
-from services.sensor_service import SensorService
+from kombu.serialization import register
+from services.sensor_service import (
+    STATUS_FRESH, STATUS_SPOILED, STATUS_WARNING, SensorService, classify_ratios
+)
 from services.alert_service import AlertService
-from models import Device, SessionLocal
+from models import Device, create_reading_partitions, drop_reading_partitions, unit_of_work
 from config import settings
 
+# orjson encodes task messages and results in C, datetimes included
+register(
+    'orjson',
+    orjson.dumps,
+    orjson.loads,
+    content_type='application/x-orjson',
+    content_encoding='binary'
+)
+
 # Configure Celery
 celery_app = Celery(
     'food_spoil_detector',
@@ -15,11 +33,13 @@ celery_app = Celery(
 )
 
 celery_app.conf.update(
-    task_serializer='json',
-    accept_content=['json'],
-    result_serializer='json',
+    task_serializer='orjson',
+    accept_content=['orjson', 'json'],
+    result_serializer='orjson',
     timezone='UTC',
     enable_utc=True,
+    worker_prefetch_multiplier=4,
+    task_acks_late=True,
     beat_schedule={
         'collect-sensor-data': {
             'task': 'tasks.collect_all_devices_data',
@@ -29,122 +49,216 @@ celery_app.conf.update(
             'task': 'tasks.cleanup_old_data',
             'schedule': 3600.0,  # Every hour
         },
+        'create-reading-partitions': {
+            'task': 'tasks.create_upcoming_partitions',
+            'schedule': 86400.0,  # Every day
+        },
     }
 )
 
 logger = structlog.get_logger()
 
+# Kept for the life of the worker process so the HTTP connection pool is
+# reused across poll cycles; built lazily, after the worker has forked.
+_event_loop: Optional[asyncio.AbstractEventLoop] = None
+_http_session: Optional[aiohttp.ClientSession] = None
+
+# One SensorService/AlertService per worker process, shared by its tasks so
+# they reuse the same Redis, HTTP and Twilio clients
+_services: Dict[str, Any] = {}
+
+@worker_process_init.connect
+def _init_services(**_):
+    _services['sensor'] = SensorService()
+    _services['alert'] = AlertService()
+
+def _get_services() -> Tuple[SensorService, AlertService]:
+    # worker_process_init only fires for prefork children, not e.g. the solo pool
+    if not _services:
+        _init_services()
+    return _services['sensor'], _services['alert']
+
+def _run_async(coro):
+    global _event_loop
+    if _event_loop is None or _event_loop.is_closed():
+        _event_loop = asyncio.new_event_loop()
+    return _event_loop.run_until_complete(coro)
+
+async def _fetch_all(sensor_service: SensorService, devices: List[Tuple[str, str]]) -> List[Any]:
+    """Poll every device concurrently; failures are returned in place of results"""
+    global _http_session
+    if _http_session is None or _http_session.closed:
+        _http_session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=100, keepalive_timeout=max(30, settings.POLL_INTERVAL * 3))
+        )
+    
+    return await asyncio.gather(
+        *(sensor_service.fetch_device_status_async(_http_session, url) for _, url in devices),
+        return_exceptions=True
+    )
+
+def _process_reading(sensor_service: SensorService, alert_service: AlertService,
+                     device_id: str, raw_data: Dict[str, Any]) -> float:
+    """Store a raw device reading and update its alerts, returning the ratio"""
+    normalized = sensor_service.normalize_reading(raw_data, device_id)
+    sensor_service.save_reading(normalized)
+    
+    # Check for alerts
+    ratio = normalized["ratio"]
+    if ratio <= settings.RATIO_WARNING:
+        alert_service.create_alert(device_id, "spoiled", ratio)
+    elif ratio <= settings.RATIO_FRESH:
+        alert_service.create_alert(device_id, "warning", ratio)
+    else:
+        alert_service.resolve_alerts(device_id)
+    
+    return ratio
+
+def _apply_alert_rules(alert_service: AlertService, readings: List[Dict[str, Any]]) -> int:
+    """Create or resolve alerts for a batch of readings, returning the alerts created"""
+    if not readings:
+        return 0
+    
+    buckets = classify_ratios([r["ratio"] for r in readings])
+    
+    alerts = [
+        (readings[i]["device_id"], "spoiled", readings[i]["ratio"])
+        for i in np.flatnonzero(buckets == STATUS_SPOILED)
+    ] + [
+        (readings[i]["device_id"], "warning", readings[i]["ratio"])
+        for i in np.flatnonzero(buckets == STATUS_WARNING)
+    ]
+    if alerts:
+        alert_service.create_alerts(alerts)
+    
+    for i in np.flatnonzero(buckets == STATUS_FRESH):
+        alert_service.resolve_alerts(readings[i]["device_id"])
+    
+    return len(alerts)
+
 @celery_app.task
 def collect_device_data(device_id: str, device_url: str):
     """Collect data from a single device"""
-    sensor_service = SensorService()
-    alert_service = AlertService()
+    sensor_service, alert_service = _get_services()
+    log = logger.bind(device_id=device_id)
     
     try:
         raw_data = sensor_service.fetch_device_status(device_url)
-        normalized = sensor_service.normalize_reading(raw_data, device_id)
-        reading = sensor_service.save_reading(normalized)
-        
-        # Check for alerts
-        ratio = normalized["ratio"]
-        if ratio <= settings.RATIO_WARNING:
-            alert_service.create_alert(device_id, "spoiled", ratio)
-        elif ratio <= settings.RATIO_FRESH:
-            alert_service.create_alert(device_id, "warning", ratio)
-        else:
-            alert_service.resolve_alerts(device_id)
+        ratio = _process_reading(sensor_service, alert_service, device_id, raw_data)
+        # Write before the late ack; the buffer dies with the worker process
+        sensor_service.flush()
         
-        logger.info("Data collected", device_id=device_id, ratio=ratio)
+        log.info("Data collected", ratio=ratio)
         return {"status": "success", "ratio": ratio}
         
     except Exception as e:
-        logger.error("Data collection failed", device_id=device_id, error=str(e))
+        log.error("Data collection failed", error=str(e))
         return {"status": "error", "error": str(e)}
 
 @celery_app.task
 def collect_all_devices_data():
-    """Collect data from all active devices"""
-    session = SessionLocal()
-    try:
-        devices = session.query(Device).filter(Device.is_active == True).all()
+    """Collect data from all active devices in one concurrent poll"""
+    with unit_of_work() as session:
+        devices = [
+            (device.device_id, device.url)
+            for device in session.query(Device).filter(Device.is_active == True).all()
+        ]
+    
+    sensor_service, alert_service = _get_services()
+    
+    results = _run_async(_fetch_all(sensor_service, devices))
+    
+    readings = []
+    for (device_id, _), raw_data in zip(devices, results):
+        if isinstance(raw_data, BaseException):
+            logger.error("Data collection failed", device_id=device_id, error=str(raw_data))
+            continue
         
-        for device in devices:
-            collect_device_data.delay(device.device_id, device.url)
+        try:
+            normalized = sensor_service.normalize_reading(raw_data, device_id)
+            sensor_service.save_reading(normalized)
+            readings.append(normalized)
+        except Exception as e:
+            logger.error("Data collection failed", device_id=device_id, error=str(e))
+    
+    # Write the whole poll cycle as one batch
+    sensor_service.flush()
+    
+    alert_count = _apply_alert_rules(alert_service, readings)
+    
+    logger.info("Data collection completed",
+               device_count=len(devices),
+               collected=len(readings),
+               alerts=alert_count)
+    return {"polled_devices": len(devices), "collected_devices": len(readings), "alerts": alert_count}
+
+@celery_app.task
+def create_upcoming_partitions():
+    """Create sensor reading partitions ahead of time"""
+    try:
+        with unit_of_work() as session:
+            partitions = create_reading_partitions(session)
         
-        logger.info("Scheduled data collection", device_count=len(devices))
-        return {"scheduled_devices": len(devices)}
+        logger.info("Partitions ensured", partitions=partitions)
+        return {"partitions": partitions}
         
-    finally:
-        session.close()
+    except Exception as e:
+        logger.error("Partition creation failed", error=str(e))
+        raise
 
 @celery_app.task
 def cleanup_old_data():
     """Clean up old sensor readings and alerts"""
-    session = SessionLocal()
     try:
         # Keep only last 30 days of data
         cutoff_date = datetime.utcnow() - timedelta(days=30)
         
-        from models import SensorReading, Alert
+        from models import Alert
         
-        # Delete old readings
-        old_readings = session.query(SensorReading)\
-            .filter(SensorReading.timestamp < cutoff_date)\
-            .delete()
-        
-        # Delete old resolved alerts
-        old_alerts = session.query(Alert)\
-            .filter(
-                Alert.timestamp < cutoff_date,
-                Alert.is_resolved == True
-            ).delete()
-        
-        session.commit()
+        with unit_of_work() as session:
+            # Drop whole daily partitions of old readings, no DELETE/vacuum needed
+            dropped_partitions = drop_reading_partitions(session, cutoff_date)
+            
+            # Delete old resolved alerts
+            old_alerts = session.query(Alert)\
+                .filter(
+                    Alert.timestamp < cutoff_date,
+                    Alert.is_resolved == True
+                ).delete()
         
         logger.info("Cleanup completed", 
-                   readings_deleted=old_readings,
+                   partitions_dropped=dropped_partitions,
                    alerts_deleted=old_alerts)
         
         return {
-            "readings_deleted": old_readings,
+            "partitions_dropped": dropped_partitions,
             "alerts_deleted": old_alerts
         }
         
     except Exception as e:
-        session.rollback()
         logger.error("Cleanup failed", error=str(e))
         raise
-    finally:
-        session.close()
 
 @celery_app.task
 def send_daily_report(device_id: str, email: str):
     """Send daily summary report"""
-    sensor_service = SensorService()
+    sensor_service, _ = _get_services()
     
     try:
-        # Get last 24 hours of data
-        history = sensor_service.get_readings_history(device_id, hours=24)
+        # Aggregate the last 24 hours of data
+        stats = sensor_service.get_readings_stats(device_id, hours=24)
         
-        if not history:
+        if not stats["readings_count"]:
             return {"status": "no_data"}
         
-        # Calculate statistics
-        ratios = [r["ratio"] for r in history]
-        avg_ratio = sum(ratios) / len(ratios)
-        min_ratio = min(ratios)
-        max_ratio = max(ratios)
-        
-        alert_count = sum(1 for r in history if r["is_alert"])
-        
         report = {
             "device_id": device_id,
             "date": datetime.utcnow().strftime("%Y-%m-%d"),
-            "readings_count": len(history),
-            "avg_ratio": round(avg_ratio, 3),
-            "min_ratio": round(min_ratio, 3),
-            "max_ratio": round(max_ratio, 3),
-            "alert_count": alert_count
+            "readings_count": stats["readings_count"],
+            "avg_ratio": round(stats["avg_ratio"], 3),
+            "min_ratio": round(stats["min_ratio"], 3),
+            "max_ratio": round(stats["max_ratio"], 3),
+            "alert_count": stats["alert_count"]
         }
         
         # Here you would send the email